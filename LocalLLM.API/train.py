@@ -1,20 +1,26 @@
 # This file contains the script for training the model.
 # train.py  (CPU-friendly LoRA for Meta-Llama-3 family, with heartbeats & resume)
-import argparse, os, sys, json, time, threading, warnings
+import argparse, os, sys, json, time, warnings, hashlib, importlib.util, shutil, glob
+
+# OpenMP / MKL read these when torch is first imported, so set them before any
+# torch import (setdefault keeps values the caller already exported).
+for _k, _v in {
+    "OMP_NUM_THREADS": str(os.cpu_count() or 1),
+    "MKL_NUM_THREADS": str(os.cpu_count() or 1),
+    "KMP_AFFINITY": "granularity=fine,compact,1,0",
+    "KMP_BLOCKTIME": "1",
+}.items():
+    os.environ.setdefault(_k, _v)
+
+try:
+    import orjson
+except ImportError:  # optional: faster JSON parsing
+    orjson = None
 
 def log(msg: str):
     """Logs a message to the console."""
     print(msg, flush=True)
 
-def heartbeat():
-    """Prints a heartbeat message every 60 seconds."""
-    while True:
-        time.sleep(60)
-        try:
-            print("[heartbeat] still running...", flush=True)
-        except Exception:
-            break
-
 def load_yaml_cfg(path: str) -> dict:
     """Loads a YAML configuration file."""
     import yaml
@@ -34,43 +40,342 @@ def parse_args():
     p.add_argument("--bsz", type=int, default=1)           # CPU-safe default
     p.add_argument("--max_length", type=int, default=512)  # CPU-safe default
     p.add_argument("--resume", type=str, default="auto", choices=["auto","never","force"])
+    # Checkpoint every k-th decoder layer (1 = every layer, 0 = off)
+    p.add_argument("--gc_interval", type=int, default=1)
+    # Keep saved activations in pinned host RAM instead of recomputing them (CUDA only)
+    p.add_argument("--offload_activations", action="store_true")
+    # Comma-separated LoRA target projections (attention-only by default)
+    p.add_argument("--lora_targets", type=str, default="q_proj,v_proj")
+    # Pack short conversations (EOS-separated) into full max_length rows
+    p.add_argument("--pack", action="store_true")
+    # Disable torch.compile (e.g. when inductor / a C++ toolchain is unavailable)
+    p.add_argument("--no-compile", dest="compile", action="store_false")
+    # Optimize with Intel Extension for PyTorch on CPU (must match torch's major.minor)
+    p.add_argument("--ipex", action="store_true")
     return p.parse_args()
 
 def load_jsonl_rows(path: str):
     """Loads a JSONL file."""
-    rows = []
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            s = line.strip()
-            if not s: continue
-            rows.append(json.loads(s))
-    return rows
-
-def build_dataset(jsonl_path: str, tokenizer, max_length: int):
-    """Builds a dataset from a JSONL file."""
-    import datasets
-    rows = load_jsonl_rows(jsonl_path)
-
-    def to_text(ex):
-        prompt = (ex.get("prompt") or "").strip()
-        resp   = (ex.get("response") or "").strip()
-        return {"text": f"User: {prompt}\nAssistant: {resp}"}
-
-    ds = datasets.Dataset.from_list(list(map(to_text, rows)))
+    with open(path, "rb") as f:
+        data = f.read()
+    loads = orjson.loads if orjson is not None else json.loads
+    return [loads(line) for line in data.split(b"\n") if line.strip()]
+
+# Bump whenever build_dataset changes what it stores, so stale caches are ignored
+TOK_CACHE_VERSION = 5
+
+_worker_tokenizer = None
+
+def _init_tokenizer_worker(base_model: str, pad_token, n_threads: int):
+    """Loads a private tokenizer instance in each worker process."""
+    global _worker_tokenizer
+    # Size this worker's Rayon pool to its share of the cores before the first
+    # encode; by default every worker's pool would span all cores.
+    os.environ["RAYON_NUM_THREADS"] = str(n_threads)
+    from transformers import AutoTokenizer
+    _worker_tokenizer = AutoTokenizer.from_pretrained(
+        base_model,
+        use_fast=True,
+        token=os.getenv("HUGGINGFACE_HUB_TOKEN", None)
+    )
+    if _worker_tokenizer.pad_token is None:
+        _worker_tokenizer.pad_token = pad_token
+
+def _tokenize_chunk(texts, max_length: int) -> dict:
+    """Tokenizes one shard of texts with the worker's tokenizer."""
+    enc = _worker_tokenizer(
+        texts,
+        truncation=True,
+        max_length=max_length,
+        return_tensors=None,
+    )
+    return dict(enc)
 
-    def tok(batch):
-        out = tokenizer(
-            batch["text"],
+def tokenize_texts(texts, tokenizer, max_length: int) -> dict:
+    """
+    Tokenizes texts (truncated, unpadded), sharding across worker processes on
+    many-core machines.
+    The fast tokenizer stops scaling past a few dozen threads, so each worker
+    gets its own tokenizer instance and a contiguous slice of the corpus.
+    """
+    cpus = os.cpu_count() or 1
+    n = max(1, cpus // 8)
+    if n == 1 or len(texts) < 4 * n:
+        enc = tokenizer(
+            texts,
             truncation=True,
-            padding="max_length",
             max_length=max_length,
             return_tensors=None,
         )
-        # causal LM: labels = input_ids
-        out["labels"] = out["input_ids"].copy()
-        return out
+        return dict(enc)
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    step = (len(texts) + n - 1) // n
+    chunks = [texts[i:i + step] for i in range(0, len(texts), step)]
+    out = {}
+    # spawn: fresh interpreters, so RAYON_NUM_THREADS is read when each pool starts
+    with ProcessPoolExecutor(
+        max_workers=n,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_tokenizer_worker,
+        initargs=(tokenizer.name_or_path, tokenizer.pad_token, max(1, cpus // n)),
+    ) as pool:
+        for part in pool.map(_tokenize_chunk, chunks, [max_length] * len(chunks)):
+            for k, v in part.items():
+                out.setdefault(k, []).extend(v)
+    return out
+
+def pack_sequences(input_ids, max_length: int, eos_id: int, pad_id: int) -> dict:
+    """
+    Concatenates tokenized examples (EOS-separated) into fully packed rows of
+    max_length tokens. Only the final residual row is padded; its pad
+    positions are masked out of attention and labels.
+    """
+    packed = {"input_ids": [], "attention_mask": [], "labels": []}
+    buf = []
+    for ids in input_ids:
+        buf.extend(ids)
+        if not ids or ids[-1] != eos_id:
+            buf.append(eos_id)
+        while len(buf) >= max_length:
+            row, buf = buf[:max_length], buf[max_length:]
+            packed["input_ids"].append(row)
+            packed["attention_mask"].append([1] * max_length)
+            packed["labels"].append(row[:])
+    if buf:
+        n_pad = max_length - len(buf)
+        packed["input_ids"].append(buf + [pad_id] * n_pad)
+        packed["attention_mask"].append([1] * len(buf) + [0] * n_pad)
+        packed["labels"].append(buf + [-100] * n_pad)
+    return packed
+
+def build_dataset(jsonl_path: str, tokenizer, max_length: int, pack: bool = False):
+    """
+    Builds a dataset from a JSONL file, reusing a tokenized copy cached under
+    HF_DATASETS_CACHE (shared across runs, since every API job has its own outdir).
+    """
+    import datasets
+
+    # Cache key: cache layout version, dataset file + its mtime, tokenizer, max_length, packing
+    jsonl_path = os.path.abspath(jsonl_path)
+    key = hashlib.sha1(
+        f"{TOK_CACHE_VERSION}:{jsonl_path}:{os.path.getmtime(jsonl_path)}:{tokenizer.name_or_path}:{max_length}:{pack}".encode()
+    ).hexdigest()
+    cache_dir = os.path.join(str(datasets.config.HF_DATASETS_CACHE), "localllm_tok_cache", key)
+    if os.path.isdir(cache_dir):
+        try:
+            ds = datasets.load_from_disk(cache_dir)
+            log(f"[cache] Reusing tokenized dataset: {cache_dir}")
+            return ds
+        except Exception as e:
+            log(f"[WARN] Tokenized cache unreadable ({e}); rebuilding.")
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    # Arrow's multi-threaded C++ JSON reader parses straight into columns; fall
+    # back to line-by-line parsing for files whose rows have mixed schemas.
+    try:
+        raw = datasets.load_dataset("json", data_files=jsonl_path, split="train")
+        n_rows = raw.num_rows
+        cols = {c: raw[c] for c in ("prompt", "response") if c in raw.column_names}
+    except Exception as e:
+        log(f"[WARN] Arrow JSON reader failed ({e}); parsing line by line.")
+        rows = load_jsonl_rows(jsonl_path)
+        n_rows = len(rows)
+        cols = {c: [r.get(c) for r in rows] for c in ("prompt", "response")}
+    prompts   = cols.get("prompt") or [None] * n_rows
+    responses = cols.get("response") or [None] * n_rows
+
+    texts = [
+        f"User: {(prompt or '').strip()}\nAssistant: {(resp or '').strip()}"
+        for prompt, resp in zip(prompts, responses)
+    ]
+
+    # Whole-corpus calls let the fast tokenizer batch in Rust instead of
+    # being fed micro-batches from Python by ds.map.
+    enc = tokenize_texts(texts, tokenizer, max_length)
+    if pack:
+        enc = pack_sequences(
+            enc["input_ids"], max_length, tokenizer.eos_token_id, tokenizer.pad_token_id
+        )
+    else:
+        # causal LM: labels = input_ids. No padding here; the collator pads each
+        # batch to its longest sequence and fills padded label positions with -100
+        # so the loss skips them (pad_token may equal eos, so mask by position).
+        enc["labels"] = [ids[:] for ids in enc["input_ids"]]
+        # lets the Trainer's length-grouped sampler bucket similar lengths
+        enc["length"] = [len(ids) for ids in enc["input_ids"]]
+
+    # Store token ids as int32 (mask as int8) Arrow columns instead of the
+    # default int64; the collator still receives plain lists per example.
+    features = datasets.Features({
+        "input_ids": datasets.Sequence(datasets.Value("int32")),
+        "attention_mask": datasets.Sequence(datasets.Value("int8")),
+        "labels": datasets.Sequence(datasets.Value("int32")),
+    })
+    if "length" in enc:
+        features["length"] = datasets.Value("int32")
+    ds = datasets.Dataset.from_dict(
+        {k: enc[k] for k in features}, features=features
+    )
+    # Save next to the final location and swap it in, so a run killed mid-save
+    # never leaves a half-written cache behind.
+    tmp_dir = f"{cache_dir}.tmp-{os.getpid()}"
+    # Temp dirs from runs killed mid-save are never reclaimed otherwise; the
+    # glob also covers this PID's own leftover.
+    for stale in glob.glob(glob.escape(cache_dir) + ".tmp-*"):
+        shutil.rmtree(stale, ignore_errors=True)
+    try:
+        ds.save_to_disk(tmp_dir)
+        os.replace(tmp_dir, cache_dir)
+    except OSError as e:
+        # cache already populated by another run, or a concurrent run cleared our
+        # temp dir; the in-memory dataset is still good, only caching is skipped
+        log(f"[cache] Tokenized dataset not cached ({e})")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return ds
+
+def cpu_supports_bf16() -> bool:
+    """Checks whether the CPU has native BF16 matmul support (AMX or AVX-512 BF16)."""
+    import torch
+    try:
+        if hasattr(torch.cpu, "_is_amx_tile_supported") and torch.cpu._is_amx_tile_supported():
+            return True
+    except Exception:
+        pass
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            flags = f.read()
+        return "amx_bf16" in flags or "avx512_bf16" in flags
+    except OSError:
+        return False
+
+def enable_interval_checkpointing(model, k: int) -> bool:
+    """
+    Checkpoints only every k-th decoder layer instead of all of them.
+    The other layers keep their activations, trading some memory for
+    skipping their re-forward during backward.
+    """
+    import torch
+    from torch.utils.checkpoint import checkpoint
+
+    layers = getattr(getattr(model, "model", None), "layers", None)
+    if layers is None:
+        return False
+
+    for idx, layer in enumerate(layers):
+        if idx % k != 0:
+            continue
+
+        def forward(*a, _layer=layer, _orig=layer.forward, **kw):
+            if not (_layer.training and torch.is_grad_enabled()):
+                return _orig(*a, **kw)
+            return checkpoint(_orig, *a, use_reentrant=False, **kw)
+
+        layer.forward = forward
+    return True
+
+# Non-weight files needed to load the config and tokenizer from a snapshot
+HUB_META_PATTERNS = ["*.json", "*.model", "*.tiktoken", "*.txt"]
 
-    return ds.map(tok, batched=True, remove_columns=["text"])
+def snapshot_weights_format(path: str):
+    """
+    Returns "safetensors" or "bin" when the snapshot at path holds a config,
+    tokenizer files and a complete set of weights, else None (for example
+    after an interrupted download).
+    """
+    if not os.path.isfile(os.path.join(path, "config.json")):
+        return None
+    if not any(os.path.isfile(os.path.join(path, n))
+               for n in ("tokenizer.json", "tokenizer_config.json", "tokenizer.model")):
+        return None
+    for fmt, index, single in (
+        ("safetensors", "model.safetensors.index.json", "model.safetensors"),
+        ("bin", "pytorch_model.bin.index.json", "pytorch_model.bin"),
+    ):
+        index_path = os.path.join(path, index)
+        if os.path.isfile(index_path):
+            with open(index_path, "rb") as f:
+                shards = set(json.loads(f.read())["weight_map"].values())
+            if all(os.path.isfile(os.path.join(path, sh)) for sh in shards):
+                return fmt
+        elif os.path.isfile(os.path.join(path, single)):
+            return fmt
+    return None
+
+def prefetch_base_model(base_model: str):
+    """
+    Resolves the base model to a complete local snapshot, downloading it if
+    needed. Returns (path, use_safetensors); loading from path skips Hub
+    repository resolution. path is None when the snapshot can't be resolved,
+    and transformers then resolves base_model itself.
+    """
+    if os.path.isdir(base_model):
+        return None, None
+    try:
+        from huggingface_hub import snapshot_download
+    except ImportError:
+        return None, None
+
+    token = os.getenv("HUGGINGFACE_HUB_TOKEN", None)
+    fmt = None
+    try:
+        path = snapshot_download(base_model, local_files_only=True, token=token)
+        fmt = snapshot_weights_format(path)
+    except Exception:
+        pass
+
+    if fmt is not None:
+        log(f"[hub] Using cached snapshot: {path}")
+    else:
+        try:
+            log("[hub] Downloading base model snapshot...")
+            # Only one weight format (and none of the original/*.pth copies):
+            # prefer safetensors, fetch .bin only when the repo has none.
+            path = snapshot_download(
+                base_model, token=token, allow_patterns=HUB_META_PATTERNS + ["*.safetensors"]
+            )
+            fmt = snapshot_weights_format(path)
+            if fmt is None:
+                path = snapshot_download(
+                    base_model, token=token, allow_patterns=HUB_META_PATTERNS + ["*.bin"]
+                )
+                fmt = snapshot_weights_format(path)
+        except Exception as e:
+            log(f"[WARN] snapshot_download failed ({e}); transformers will resolve the model itself.")
+            return None, None
+        if fmt is None:
+            log("[WARN] Snapshot has no complete weights; transformers will resolve the model itself.")
+            return None, None
+
+    return path, (True if fmt == "safetensors" else None)
+
+def load_ipex(torch_version: str):
+    """
+    Imports intel_extension_for_pytorch if it matches torch's major.minor, else
+    returns None. A mismatched build exits the process from its own __init__,
+    so check the installed version before importing.
+    """
+    from importlib import metadata
+    try:
+        ipex_version = metadata.version("intel_extension_for_pytorch")
+    except metadata.PackageNotFoundError:
+        log("[WARN] --ipex set but intel_extension_for_pytorch is not installed.")
+        return None
+
+    def major_minor(v: str):
+        return tuple(v.split("+")[0].split(".")[:2])
+
+    if major_minor(ipex_version) != major_minor(torch_version):
+        log(f"[WARN] intel_extension_for_pytorch {ipex_version} does not match "
+            f"torch {torch_version}; skipping IPEX.")
+        return None
+    try:
+        import intel_extension_for_pytorch as ipex
+    except (Exception, SystemExit) as e:
+        log(f"[WARN] Could not import intel_extension_for_pytorch ({e!r}); skipping IPEX.")
+        return None
+    return ipex
 
 def normalize_base_model_id(s: str) -> str:
     """
@@ -94,6 +399,16 @@ def normalize_base_model_id(s: str) -> str:
     }
     return aliases.get(key, s.strip())
 
+# Ollama Modelfile written next to the adapter (preformatted bytes, one write)
+MODELFILE = (
+    b'FROM llama3:8b\n'
+    b'ADAPTER ./adapter_model.safetensors\n\n'
+    b'SYSTEM "You are a concise E-commerce Returns & Refunds assistant. Stick strictly to policy."\n\n'
+    b'TEMPLATE "User: {{ {{ .Prompt }} }}\nAssistant:"\n\n'
+    b'PARAMETER temperature 0.2\n'
+    b'PARAMETER num_predict 256\n'
+)
+
 def main():
     """The main function."""
     warnings.filterwarnings("ignore", category=UserWarning, module="torch.utils.data.dataloader")
@@ -108,10 +423,25 @@ def main():
         outdir      = cfg.get("output_dir", args.outdir)
         bsz         = int(cfg.get("batch_size", cfg.get("bsz", args.bsz)))
         max_length  = int(cfg.get("max_length", args.max_length))
+        gc_interval = int(cfg.get("gc_interval", args.gc_interval))
+        offload_activations = bool(cfg.get("offload_activations", args.offload_activations))
+        lora_targets = cfg.get("lora_targets", args.lora_targets)
+        pack        = bool(cfg.get("pack", args.pack))
+        compile_model = bool(cfg.get("compile", args.compile))
+        use_ipex    = bool(cfg.get("ipex", args.ipex))
     else:
         data_path   = args.data
         base_model_raw  = args.base.strip()
         epochs, lr, outdir, bsz, max_length = args.epochs, args.lr, args.outdir, args.bsz, args.max_length
+        gc_interval = args.gc_interval
+        offload_activations = args.offload_activations
+        lora_targets = args.lora_targets
+        pack = args.pack
+        compile_model = args.compile
+        use_ipex = args.ipex
+
+    if isinstance(lora_targets, str):
+        lora_targets = [t.strip() for t in lora_targets.split(",") if t.strip()]
 
     # NEW: normalize Ollama tags -> HF repo ids
     base_model = normalize_base_model_id(base_model_raw)
@@ -137,29 +467,126 @@ def main():
     log(f" learning_rate: {lr}")
     log(f" batch_size   : {bsz}")
     log(f" max_length   : {max_length}")
+    log(f" gc_interval  : {gc_interval}")
+    log(f" offload_acts : {offload_activations}")
+    log(f" lora_targets : {','.join(lora_targets)}")
+    log(f" pack         : {pack}")
+    log(f" compile      : {compile_model}")
+    log(f" ipex         : {use_ipex}")
     log(f" output_dir   : {outdir}")
     log("="*53)
 
-    # # Start a heartbeat thread so you always see activity in train.log
-    # t = threading.Thread(target=heartbeat, daemon=True)
-    # t.start()
-
     import torch
-    if not torch.cuda.is_available():
+    use_cuda = torch.cuda.is_available()
+    if not use_cuda:
         try:
             torch.set_num_threads(max(1, os.cpu_count() or 1))
+            # intra-op GEMMs use all cores; one inter-op thread avoids oversubscription
+            torch.set_num_interop_threads(1)
         except Exception:
             pass
 
+    if offload_activations and not use_cuda:
+        log("[WARN] --offload_activations needs CUDA; ignoring it on CPU.")
+        offload_activations = False
+    if offload_activations:
+        # Saved activations go to host RAM, so recomputing layers buys nothing
+        gc_interval = 0
+
+    if compile_model:
+        # torch.compile raises outright where Dynamo is unsupported (e.g. newer
+        # Python on older torch), and API runs can't pass --no-compile, so check first.
+        try:
+            import torch._dynamo
+            dynamo_ok = hasattr(torch, "compile") and torch._dynamo.is_dynamo_supported()
+        except Exception:
+            dynamo_ok = False
+        if not dynamo_ok:
+            log("[WARN] torch.compile / Dynamo not supported on this platform; running eager.")
+            compile_model = False
+    if compile_model:
+        # Fall back to eager for graphs inductor can't handle instead of failing the run
+        torch._dynamo.config.suppress_errors = True
+        # accelerate's dynamo plugin reads this: compile with dynamic shapes so
+        # varying batch lengths don't trigger a recompile each
+        os.environ.setdefault("ACCELERATE_DYNAMO_USE_DYNAMIC", "true")
+
+    # BF16 on CPUs with AMX / AVX-512 BF16: ~2x matmul throughput, half the memory traffic
+    cpu_bf16 = not use_cuda and cpu_supports_bf16()
+    cuda_bf16 = use_cuda and torch.cuda.is_bf16_supported()
+    if cpu_bf16:
+        log("[cpu] BF16 support detected (AMX / AVX-512 BF16) -> training in bfloat16")
+        torch.set_float32_matmul_precision("medium")
+
+    # Resolve the model to a complete local snapshot up front; tokenizer and model
+    # then load from that directory without resolving the Hub repository again.
+    model_path, use_safetensors = prefetch_base_model(base_model)
+    model_src = model_path or base_model
+
     from transformers import (
         AutoTokenizer, AutoModelForCausalLM,
-        TrainingArguments, Trainer, DataCollatorForLanguageModeling
+        TrainingArguments, Trainer, TrainerCallback, DataCollatorForSeq2Seq
     )
-    from peft import LoraConfig, get_peft_model
+    from transformers.trainer_utils import get_last_checkpoint
+    from peft import LoraConfig, get_peft_model, prepare_model_for_kbit_training
+
+    class Heartbeat(TrainerCallback):
+        """Prints a heartbeat at step end when 60s have passed since the last one."""
+        def __init__(self, interval: float = 60.0):
+            self.interval = interval
+            self.last = time.time()
+
+        def on_step_end(self, args, state, control, **kwargs):
+            now = time.time()
+            if now - self.last > self.interval:
+                log(f"[heartbeat] step {state.global_step}/{state.max_steps}")
+                self.last = now
+
+    class OffloadActivationsTrainer(Trainer):
+        """Trainer that parks tensors saved for backward in pinned host memory."""
+        def compute_loss(self, *args, **kwargs):
+            with torch.autograd.graph.save_on_cpu(pin_memory=True):
+                return super().compute_loss(*args, **kwargs)
+
+    # Intel Extension for PyTorch: fused Linear/norm kernels and AMX/AVX-512 BF16 dispatch on CPU
+    ipex = None
+    if use_ipex and use_cuda:
+        log("[WARN] --ipex only applies to CPU training; ignoring it.")
+    elif use_ipex:
+        ipex = load_ipex(torch.__version__)
+
+    class IpexTrainer(Trainer):
+        """Trainer that runs the model/optimizer pair through ipex.optimize."""
+        def create_optimizer(self, *args, **kwargs):
+            optimizer = super().create_optimizer(*args, **kwargs)
+            self.model.train()
+            self.model, self.optimizer = ipex.optimize(
+                self.model,
+                optimizer=optimizer,
+                dtype=torch.bfloat16 if cpu_bf16 else torch.float32,
+                level="O1",
+                inplace=True,
+            )
+            return self.optimizer
+
+    # QLoRA: only the adapters train, so the frozen base can sit in 4-bit on GPU
+    quant_cfg = None
+    if use_cuda:
+        try:
+            import bitsandbytes  # noqa: F401
+            from transformers import BitsAndBytesConfig
+            quant_cfg = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=torch.bfloat16 if cuda_bf16 else torch.float16,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True,
+            )
+        except ImportError:
+            log("[WARN] bitsandbytes not available; loading base model unquantized.")
 
     log("STEP 1/6: Loading tokenizer...")
     tokenizer = AutoTokenizer.from_pretrained(
-        base_model,
+        model_src,
         use_fast=True,
         token=os.getenv("HUGGINGFACE_HUB_TOKEN", None)
     )
@@ -167,33 +594,70 @@ def main():
         tokenizer.pad_token = tokenizer.eos_token
 
     log("STEP 2/6: Building & tokenizing dataset...")
-    train_ds = build_dataset(data_path, tokenizer, max_length)
+    train_ds = build_dataset(data_path, tokenizer, max_length, pack=pack)
 
     log("STEP 3/6: Loading base model (this can take a while the first time)...")
+    device_map = None
+    if quant_cfg is not None:
+        device_map = {"": 0}
+    elif use_cuda and importlib.util.find_spec("accelerate") is not None:
+        device_map = "auto"
     model = AutoModelForCausalLM.from_pretrained(
-        base_model,
+        model_src,
         token=os.getenv("HUGGINGFACE_HUB_TOKEN", None),
         low_cpu_mem_usage=True,
-        torch_dtype=torch.float32 if not torch.cuda.is_available() else None,
-        device_map=None,
+        use_safetensors=use_safetensors,
+        torch_dtype=None if use_cuda else (torch.bfloat16 if cpu_bf16 else torch.float32),
+        quantization_config=quant_cfg,
+        device_map=device_map,
     )
     model.config.pad_token_id = tokenizer.pad_token_id
-
-    try:
-        model.gradient_checkpointing_enable()
-    except Exception:
-        pass
+    # Training never reuses the KV cache; without this every forward builds one and
+    # holds all layers' K/V until it returns (whatever the checkpointing setting).
+    model.config.use_cache = False
+    if quant_cfg is not None:
+        log("[cuda] Base model loaded in 4-bit NF4 (QLoRA)")
+        model = prepare_model_for_kbit_training(model, use_gradient_checkpointing=gc_interval == 1)
+
+    if gc_interval == 1:
+        try:
+            model.gradient_checkpointing_enable()
+        except Exception:
+            pass
+    elif gc_interval > 1:
+        if not enable_interval_checkpointing(model, gc_interval):
+            log("[WARN] Could not find decoder layers; gradient checkpointing disabled.")
 
     log("STEP 4/6: Applying LoRA adapters...")
     lora_cfg = LoraConfig(
         r=8, lora_alpha=16, lora_dropout=0.05,
         bias="none", task_type="CAUSAL_LM",
-        target_modules=["q_proj","k_proj","v_proj","o_proj","gate_proj","up_proj","down_proj"]
+        target_modules=lora_targets
     )
     model = get_peft_model(model, lora_cfg)
+    # record the Hub id, not the local snapshot path, in adapter_config.json
+    model.peft_config["default"].base_model_name_or_path = base_model
 
     log("STEP 5/6: Starting training...")
-    use_cuda = torch.cuda.is_available()
+    # Optimizer: 8-bit paged AdamW states with bitsandbytes on GPU; otherwise the
+    # fused AdamW kernel (CPU support needs torch >= 2.4). IPEX swaps in its own
+    # fused AdamW, so it gets the plain one.
+    torch_ver = tuple(int(x) for x in torch.__version__.split("+")[0].split(".")[:2])
+    if quant_cfg is not None:
+        optim = "paged_adamw_8bit"
+    elif ipex is not None or (not use_cuda and torch_ver < (2, 4)):
+        optim = "adamw_torch"
+    else:
+        optim = "adamw_torch_fused"
+    log(f"[optim] {optim}")
+
+    # Collate in background workers so the next batch is ready when a step ends
+    dl_workers = max(0, int(os.getenv("DL_WORKERS", "2")))
+    if dl_workers > 0:
+        # Tokenization above already used the Rust thread pool; without this every
+        # forked worker prints the tokenizers fork warning into train.log. Set here,
+        # not at import, so build_dataset's single-call tokenization stays parallel.
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
     args_train = TrainingArguments(
         output_dir=hf_out,
         per_device_train_batch_size=bsz,
@@ -204,33 +668,51 @@ def main():
         save_strategy="epoch",
         save_total_limit=2,
         report_to=[],
+        optim=optim,
+        # packed rows are all max_length, so length grouping only helps unpacked data
+        group_by_length=not pack,
+        length_column_name="length",
         dataloader_pin_memory=use_cuda,
-        fp16=use_cuda,
-        bf16=False,
+        dataloader_num_workers=dl_workers,
+        dataloader_persistent_workers=dl_workers > 0,
+        dataloader_prefetch_factor=4 if dl_workers > 0 else None,
+        fp16=use_cuda and not cuda_bf16,
+        bf16=cpu_bf16 or cuda_bf16,
+        bf16_full_eval=cpu_bf16,
+        torch_compile=compile_model,
+        torch_compile_mode="reduce-overhead" if compile_model else None,
     )
-    trainer = Trainer(
+    if offload_activations:
+        trainer_cls = OffloadActivationsTrainer
+    elif ipex is not None:
+        log("[cpu] Intel Extension for PyTorch -> ipex.optimize(level=O1)")
+        trainer_cls = IpexTrainer
+    else:
+        trainer_cls = Trainer
+    trainer = trainer_cls(
         model=model,
         args=args_train,
         train_dataset=train_ds,
-        data_collator=DataCollatorForLanguageModeling(tokenizer=tokenizer, mlm=False),
+        data_collator=DataCollatorForSeq2Seq(
+            tokenizer=tokenizer, label_pad_token_id=-100, pad_to_multiple_of=8
+        ),
+        callbacks=[Heartbeat()],
     )
 
     # Auto-resume if a checkpoint exists
-    ckpt = None
-    if os.path.isdir(hf_out):
-        ckpts = [d for d in os.listdir(hf_out) if d.startswith("checkpoint-")]
-        if ckpts:
-            ckpts.sort(key=lambda n: int(n.split("-")[-1]) if "-" in n else -1)
-            ckpt = os.path.join(hf_out, ckpts[-1])
-
+    ckpt = get_last_checkpoint(hf_out) if os.path.isdir(hf_out) else None
     if ckpt:
         log(f"[resume] Found checkpoint: {ckpt}")
-        trainer.train(resume_from_checkpoint=ckpt)
-    else:
-        trainer.train()
+    trainer.train(resume_from_checkpoint=ckpt)
 
     log("STEP 6/6: Saving LoRA adapter...")
-    model.save_pretrained(outdir, safe_serialization=True)
+    # Explicit override: never write embedding weights next to the adapter, even if
+    # lora_targets pulls in embed_tokens / lm_head (PEFT's "auto" would save them).
+    model.save_pretrained(
+        outdir,
+        safe_serialization=True,
+        save_embedding_layers=False,
+    )
 
     # Ensure Ollama can consume the adapter:
     adapter = os.path.join(outdir, "adapter_model.safetensors")
@@ -244,23 +726,20 @@ def main():
             "bias": "none",
             "inference_mode": True,
             "lora_alpha": 16, "lora_dropout": 0.05, "peft_type": "LORA",
-            "r": 8, "target_modules": ["q_proj","k_proj","v_proj","o_proj","gate_proj","up_proj","down_proj"],
+            "r": 8, "target_modules": lora_targets,
             "task_type": "CAUSAL_LM"
         }
-        with open(cfg, "w", encoding="utf-8") as f:
-            json.dump(fallback, f, ensure_ascii=False, indent=2)
+        if orjson is not None:
+            payload = orjson.dumps(fallback, option=orjson.OPT_INDENT_2)
+        else:
+            payload = json.dumps(fallback, ensure_ascii=False, indent=2).encode("utf-8")
+        with open(cfg, "wb") as f:
+            f.write(payload)
 
     # Write Modelfile for Ollama. You can switch FROM to llama3:8b later.
     modelfile = os.path.join(outdir, "Modelfile")
-    with open(modelfile, "w", encoding="utf-8") as f:
-        f.write(
-            'FROM llama3:8b\n'
-            'ADAPTER ./adapter_model.safetensors\n\n'
-            'SYSTEM "You are a concise E-commerce Returns & Refunds assistant. Stick strictly to policy."\n\n'
-            'TEMPLATE "User: {{ {{ .Prompt }} }}\nAssistant:"\n\n'
-            'PARAMETER temperature 0.2\n'
-            'PARAMETER num_predict 256\n'
-        )
+    with open(modelfile, "wb") as f:
+        f.write(MODELFILE)
 
     log(f"[OK] Artifacts ready in: {outdir}")
     return 0